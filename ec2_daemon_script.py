@@ -1,4 +1,7 @@
+import hashlib
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
 import docker
 import time
 from loguru import logger
@@ -11,10 +14,20 @@ import traceback
 
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = 6379
+# Unix domain socket used instead of TCP when Redis runs on this host - skips the loopback TCP stack on every command
+REDIS_SOCKET_PATH = os.environ.get("REDIS_SOCKET_PATH", "/var/run/redis/redis.sock")
+USE_UNIX_SOCKET = REDIS_HOST in ("localhost", "127.0.0.1") and os.path.exists(
+    REDIS_SOCKET_PATH
+)
 # Prefix for all lock keys in Redis
 LOCK_PREFIX = "ec2_container_lock"
 # duration in seconds for which the lock is valid without being refreshed
 LOCK_TIMEOUT = 120
+# interval in seconds at which held locks are extended - a third of the timeout leaves margin for slow ticks
+EXTEND_INTERVAL = LOCK_TIMEOUT / 3
+# Value stored in a lock key to identify this instance as the lock holder, e.g. ip-172-29-89-168:1234
+# Stored as bytes so that it can be compared directly against values returned by Redis
+LOCK_OWNER_ID = f"{socket.gethostname()}:{os.getpid()}".encode()
 
 # Docker configuration for multiple containers
 CONTAINERS = {
@@ -27,139 +40,302 @@ CONTAINERS = {
         "lock_name": f"{LOCK_PREFIX}::pyapi",
     },
 }
-
-# Initialize Redis and Docker clients
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
-docker_client = docker.from_env()
+# Lock keys for each container, encoded once so that redis-py does not re-encode them on every command
+LOCK_KEYS = {
+    container_id: container["lock_name"].encode()
+    for container_id, container in CONTAINERS.items()
+}
+# Maps lock keys back to their container, used to route keyspace notifications
+LOCK_NAME_TO_CONTAINER = {
+    lock_key: container_id for container_id, lock_key in LOCK_KEYS.items()
+}
+# Keyspace notification channels fired when a lock key expires or is deleted (db 0)
+LOCK_EXPIRED_CHANNEL = "__keyevent@0__:expired"
+LOCK_DELETED_CHANNEL = "__keyevent@0__:del"
+# Keyspace notification flags required - E: keyevent channels, g: generic commands (DEL), x: expired events
+NOTIFY_KEYSPACE_EVENTS = "Egx"
+
+# Initialize Redis client
+# TCP keepalive keeps the connection warm between ticks so idle NATs/gateways do not drop it (ignored over the Unix socket).
+# Only connection errors and timeouts are retried, with exponential backoff (capped at 5 seconds) - anything else surfaces immediately.
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    unix_socket_path=REDIS_SOCKET_PATH if USE_UNIX_SOCKET else None,
+    retry=Retry(ExponentialBackoff(cap=5, base=0.1), 3),
+    retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError],
+    socket_keepalive=True,
+    socket_keepalive_options={
+        socket.TCP_KEEPIDLE: 30,
+        socket.TCP_KEEPINTVL: 10,
+        socket.TCP_KEEPCNT: 3,
+    },
+    health_check_interval=30,
+)
+
+# Lua script to atomically acquire the lock (SET NX EX).
+# If the lock is already held by us (e.g. a retried call), refresh its expiry instead so re-acquiring is idempotent.
+LUA_ACQUIRE = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+elseif redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('expire', KEYS[1], ARGV[2])
+    return 1
+else
+    return 0
+end
+"""
+# Lua script to extend the lock expiry only if it is still held by us (compare-and-expire)
+LUA_EXTEND = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+# Lua script to delete the lock only if it is still held by us (compare-and-delete)
+LUA_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+# Scripts are invoked via EVALSHA by their SHA1 digest, computed locally so that no round-trip is needed.
+# They are only loaded into Redis when it reports NOSCRIPT (see execute_pipeline).
+ACQUIRE_SHA = hashlib.sha1(LUA_ACQUIRE.encode()).hexdigest()
+EXTEND_SHA = hashlib.sha1(LUA_EXTEND.encode()).hexdigest()
+RELEASE_SHA = hashlib.sha1(LUA_RELEASE.encode()).hexdigest()
 
 # Stores the current lock values for each container if this instance holds the lock
 current_locks = {}
 # Tracks whether each container is running on this instance
 containers_running = {container_id: False for container_id in CONTAINERS}
+# Whether the Redis server supports conditional SET IFEQ / DELEX (Redis 8.4+), re-checked on every sweep
+# (None until the first check, the Lua scripts are used meanwhile)
+native_conditional_commands = None
+# Whether keyspace notifications were enabled at the last check (None until the first check)
+keyspace_notifications_enabled = None
+# Docker client, created on first use so that standby instances never connect to the Docker daemon
+_docker_client = None
+# Docker container objects cached by container ID so that they are only looked up once
+_docker_cache = {}
+
+
+def acquire_lock(container_id, pipe):
+    """
+    Queue an attempt to acquire the distributed lock for a specific container in Redis.
+    The queued command returns 1 if the lock is acquired, 0 otherwise.
+
+    :param container_id: ID of the container to acquire the lock for
+    :param pipe: Redis pipeline to queue the command on
+    """
+    lock_name = LOCK_KEYS[container_id]
+    # Atomic SET NX EX - also succeeds if we already hold the lock, so retries are safe
+    pipe.evalsha(ACQUIRE_SHA, 1, lock_name, LOCK_OWNER_ID, LOCK_TIMEOUT)
 
 
-def retry_on_exception(retries=3, delay=5):
+def extend_lock(container_id, lock_value, pipe):
     """
-    Decorator to retry a function on exception up to a specified number of times.
+    Queue an attempt to extend the lifetime of the current lock for a specific container.
+    This is done by updating the expiration time of the lock key in Redis.
+    If an instance has acquired a lock it should keep extending the lock so that other instances do not acquire the lock.
+    The queued command returns 1 if the lock is extended, 0 otherwise.
 
-    :param retries: Number of retry attempts
-    :param delay: Delay between retries in seconds
+    :param container_id: ID of the container to extend the lock for
+    :param lock_value: Value of the lock currently held by this instance
+    :param pipe: Redis pipeline to queue the command on
     """
+    lock_name = LOCK_KEYS[container_id]
+    # Check ownership and extend in a single atomic operation
+    if native_conditional_commands:
+        pipe.execute_command(
+            "SET", lock_name, lock_value, "EX", LOCK_TIMEOUT, "IFEQ", lock_value
+        )
+    else:
+        pipe.evalsha(EXTEND_SHA, 1, lock_name, lock_value, LOCK_TIMEOUT)
 
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            for attempt in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    if attempt == retries - 1:
-                        raise
-                    logger.warning(
-                        f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {delay} seconds..."
-                    )
-                    time.sleep(delay)
 
-        return wrapper
+def load_scripts():
+    """
+    Load the Lua scripts into the Redis script cache in a single round-trip.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for script in (LUA_ACQUIRE, LUA_EXTEND, LUA_RELEASE):
+        pipe.script_load(script)
+    pipe.execute()
 
-    return decorator
 
+def execute_pipeline(queue_commands):
+    """
+    Run a batch of lock commands on a non-transactional pipeline in a single Redis round-trip.
+    If Redis does not have the Lua scripts cached (NOSCRIPT, e.g. after a restart or failover), they are
+    loaded and the batch is run again. This is safe since all lock operations are idempotent.
+    Likewise, if the native SET IFEQ / DELEX commands are rejected (e.g. after a failover to a pre-8.4 node),
+    server support is re-detected and the batch is run again with the Lua scripts.
+
+    :param queue_commands: Function queueing the commands on the pipeline passed to it
+    :return: List of command results
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    queue_commands(pipe)
+    try:
+        return pipe.execute()
+    except redis.exceptions.NoScriptError:
+        load_scripts()
+        pipe = redis_client.pipeline(transaction=False)
+        queue_commands(pipe)
+        return pipe.execute()
+    except redis.exceptions.ResponseError:
+        if not native_conditional_commands:
+            raise
+        detect_native_conditional_commands()
+        if native_conditional_commands:
+            raise
+        return execute_pipeline(queue_commands)
+
+
+def refresh_locks(container_ids):
+    """
+    Acquire or extend the locks for the given containers in a single Redis round-trip.
+    Locks held by this instance are extended, all other locks are acquired if they are free.
 
-@retry_on_exception(retries=3, delay=5)
-def acquire_lock(container_id):
+    :param container_ids: IDs of the containers to refresh the locks for
+    :return: Dictionary mapping each container ID to True if this instance holds its lock, False otherwise
     """
-    Attempt to acquire the distributed lock for a specific container in Redis.
 
-    :param container_id: ID of the container to acquire the lock for
-    :return: True if lock is acquired, False otherwise
+    def queue_commands(pipe):
+        for container_id in container_ids:
+            lock_value = current_locks.get(container_id)
+            if lock_value is not None:
+                extend_lock(container_id, lock_value, pipe)
+            else:
+                acquire_lock(container_id, pipe)
+
+    return {
+        container_id: bool(result)
+        for container_id, result in zip(container_ids, execute_pipeline(queue_commands))
+    }
+
+
+def release_locks(container_ids):
     """
-    lock_name = CONTAINERS[container_id]["lock_name"]
-    hostname = socket.gethostname()  # ip-172-29-89-168, ip-172-29-3-161, etc.
-    lock_value = f"{hostname}:{os.getpid()}"
-    # Use setnx (SET if Not eXists) to ensure atomic lock acquisition
-    if redis_client.set(lock_name, lock_value, nx=True, ex=LOCK_TIMEOUT):
-        current_locks[container_id] = lock_value
-        return True
-    return False
+    Attempt to release the current locks for the given containers if we own them.
+    All locks are released in a single Redis round-trip.
 
+    :param container_ids: IDs of the containers to release the locks for
+    """
+    held = {}
+    for container_id in container_ids:
+        lock_value = current_locks.get(container_id)
+        if lock_value is not None:
+            held[container_id] = lock_value
+
+    def queue_commands(pipe):
+        for container_id, lock_value in held.items():
+            lock_name = LOCK_KEYS[container_id]
+            # Delete the lock from redis only if it is still held by this instance (compare-and-delete, no separate GET)
+            if native_conditional_commands:
+                pipe.execute_command("DELEX", lock_name, "IFEQ", lock_value)
+            else:
+                pipe.evalsha(RELEASE_SHA, 1, lock_name, lock_value)
+
+    execute_pipeline(queue_commands)
+    # Remove the locks from the current locks dictionary
+    for container_id in held:
+        del current_locks[container_id]
 
-@retry_on_exception(retries=3, delay=5)
-def extend_lock(container_id):
+
+def get_docker_client():
     """
-    Attempt to extend the lifetime of the current lock for a specific container.
-    This is done by updating the expiration time of the lock key in Redis.
-    If an instance has acquired a lock it should keep extending the lock so that other instances do not acquire the lock.
+    Get the Docker client, connecting to the Docker daemon on first use.
 
-    :param container_id: ID of the container to extend the lock for
-    :return: True if lock is extended, False otherwise
+    :return: Docker client
     """
-    lock_name = CONTAINERS[container_id]["lock_name"]
-    if container_id in current_locks:
-        lock_value = current_locks[container_id]
-        # Check if we still own the lock before extending
-        if redis_client.get(lock_name) == lock_value.encode():
-            return redis_client.expire(lock_name, LOCK_TIMEOUT)
-    return False
+    global _docker_client
+    if _docker_client is None:
+        _docker_client = docker.from_env()
+    return _docker_client
 
 
-@retry_on_exception(retries=3, delay=5)
-def release_lock(container_id):
+def _container(container_id):
     """
-    Attempt to release the current lock for a specific container if we own it.
+    Get the Docker container object for a container, querying the Docker daemon only on first use.
 
-    :param container_id: ID of the container to release the lock for
+    :param container_id: ID of the container to get
+    :return: Docker container object
     """
-    lock_name = CONTAINERS[container_id]["lock_name"]
-    if container_id in current_locks:
-        lock_value = current_locks[container_id]
-        # Delete the lock from redis only if it is still held by this instance
-        if redis_client.get(lock_name) == lock_value.encode():
-            redis_client.delete(lock_name)
-        # Remove the lock from the current locks dictionary
-        del current_locks[container_id]
+    container = _docker_cache.get(container_id)
+    if container is None:
+        container = get_docker_client().containers.get(CONTAINERS[container_id]["name"])
+        _docker_cache[container_id] = container
+    return container
+
+
+def _run_container_action(container_id, action):
+    """
+    Call an action (e.g. start or stop) on the Docker container object for a container.
+    If the cached object is stale because the container was recreated under the same name,
+    the container is looked up again by name and the action retried once.
+
+    :param container_id: ID of the container to run the action on
+    :param action: Name of the container method to call
+    :raises docker.errors.NotFound: If no container with that name exists
+    """
+    cached = container_id in _docker_cache
+    try:
+        getattr(_container(container_id), action)()
+    except docker.errors.NotFound:
+        _docker_cache.pop(container_id, None)
+        if not cached:
+            raise
+        getattr(_container(container_id), action)()
 
 
 def start_container(container_id):
     """
     Start the Docker container if it's not already running.
+    Starting a running container is a no-op in the Docker API, so its status is not checked first.
 
     :param container_id: ID of the container to start
     """
     container_name = CONTAINERS[container_id]["name"]
     try:
-        container = docker_client.containers.get(container_name)
-        if container.status != "running":
-            container.start(detach=True)
-            containers_running[container_id] = True
-            logger.info(f"Container {container_name} started")
+        _run_container_action(container_id, "start")
+        containers_running[container_id] = True
+        logger.info("Container {} started", container_name)
     except docker.errors.NotFound:
-        logger.error(f"Container {container_name} not found")
+        _docker_cache.pop(container_id, None)
+        logger.error("Container {} not found", container_name)
 
 
 def stop_container(container_id):
     """
     Stop the Docker container if it's running.
+    Stopping a stopped container is a no-op in the Docker API, so its status is not checked first.
 
     :param container_id: ID of the container to stop
     """
     container_name = CONTAINERS[container_id]["name"]
     try:
-        container = docker_client.containers.get(container_name)
-        if container.status == "running":
-            container.stop()
-            containers_running[container_id] = False
-            logger.info(f"Container {container_name} stopped")
+        _run_container_action(container_id, "stop")
+        containers_running[container_id] = False
+        logger.info("Container {} stopped", container_name)
     except docker.errors.NotFound:
-        logger.error(f"Container {container_name} not found")
+        _docker_cache.pop(container_id, None)
+        logger.error("Container {} not found", container_name)
 
 
 def cleanup():
     """
-    Release all locks and stop all containers before exiting.
+    Stop all containers and release all locks before exiting.
+    Containers are stopped first - a standby instance takes over as soon as a lock is released,
+    so releasing earlier would leave the container running on two instances while it stops.
     """
     logger.info("Cleaning up before exit")
     for container_id in CONTAINERS:
-        release_lock(container_id)
         stop_container(container_id)
+    release_locks(list(CONTAINERS))
 
 
 def signal_handler(signum, frame):
@@ -169,52 +345,158 @@ def signal_handler(signum, frame):
     :param signum: Signal number
     :param frame: Current stack frame
     """
-    logger.info(f"Received signal {signum}. Exiting...")
+    logger.info("Received signal {}. Exiting...", signum)
     cleanup()
     sys.exit(0)
 
 
-def manage_container(container_id):
+def manage_containers(container_ids):
     """
-    Manage the state of a single container end-to-end.
+    Manage the state of the given containers end-to-end.
     Acquire Lock - Start Container - Extend Lock - Stop Container - Release Lock
+    The lock operations for all containers are batched into a single Redis round-trip.
 
-    :param container_id: ID of the container to manage
+    :param container_ids: IDs of the containers to manage
     """
-    if container_id not in current_locks and acquire_lock(container_id):
-        # We just acquired the lock, start the container
-        logger.info(f"Lock acquired for {container_id}, starting container")
-        start_container(container_id)
-    elif container_id in current_locks and not extend_lock(container_id):
-        # We failed to extend our lock, stop the container
-        logger.warning(f"Failed to extend lock for {container_id}, stopping container")
-        stop_container(container_id)
-        release_lock(container_id)
-    elif container_id not in current_locks and containers_running[container_id]:
-        # Inconsistent state: container is running but we don't have the lock
-        logger.warning(
-            f"No lock but container {container_id} running, stopping container"
+    lock_status = refresh_locks(container_ids)
+    held_before = {
+        container_id: container_id in current_locks for container_id in lock_status
+    }
+    # Record newly acquired locks before any (slow) Docker call, so cleanup() releases them if we are stopped meanwhile
+    for container_id, has_lock in lock_status.items():
+        if has_lock and not held_before[container_id]:
+            current_locks[container_id] = LOCK_OWNER_ID
+    for container_id, has_lock in lock_status.items():
+        held = held_before[container_id]
+        if not held and has_lock:
+            # We just acquired the lock, start the container
+            logger.info("Lock acquired for {}, starting container", container_id)
+            start_container(container_id)
+        elif held and not has_lock:
+            # We failed to extend our lock, stop the container
+            logger.warning(
+                "Failed to extend lock for {}, stopping container", container_id
+            )
+            stop_container(container_id)
+            # The lock is no longer ours, so there is nothing to release in Redis
+            del current_locks[container_id]
+        elif not held and containers_running[container_id]:
+            # Inconsistent state: container is running but we don't have the lock
+            logger.warning(
+                "No lock but container {} running, stopping container", container_id
+            )
+            stop_container(container_id)
+
+
+def detect_native_conditional_commands():
+    """
+    Check whether the Redis server supports the native compare-and-set commands added in Redis 8.4.
+    SET ... IFEQ and DELEX ... IFEQ then replace the extend/release Lua scripts.
+    Re-checked on every sweep, since a failover can land on a server with a different version.
+    """
+    global native_conditional_commands
+    previous = native_conditional_commands
+    version = redis_client.info("server")["redis_version"]
+    try:
+        native_conditional_commands = tuple(
+            int(part) for part in version.split(".")[:2]
+        ) >= (8, 4)
+    except ValueError:
+        # Unrecognised version format - stick to the Lua scripts, which work on every version
+        native_conditional_commands = False
+    if native_conditional_commands == previous:
+        return
+    logger.info(
+        "Redis {}: using {} for lock extension and release",
+        version,
+        "native SET IFEQ / DELEX" if native_conditional_commands else "Lua scripts",
+    )
+
+
+def enable_keyspace_notifications():
+    """
+    Enable the keyspace notifications used to detect freed locks, keeping any flags that are already set.
+    CONFIG SET is not persisted, so this is re-applied on every sweep to survive Redis restarts and failovers.
+
+    :return: True if keyspace notifications are enabled, False otherwise
+    """
+    global keyspace_notifications_enabled
+    try:
+        current = redis_client.config_get("notify-keyspace-events").get(
+            "notify-keyspace-events", ""
         )
-        stop_container(container_id)
+        missing = "".join(
+            flag for flag in NOTIFY_KEYSPACE_EVENTS if flag not in current
+        )
+        if missing:
+            if keyspace_notifications_enabled:
+                logger.warning(
+                    "Keyspace notifications were reset (Redis restart or failover?), re-enabling"
+                )
+            redis_client.config_set("notify-keyspace-events", current + missing)
+        keyspace_notifications_enabled = True
+    except redis.exceptions.ResponseError as e:
+        # Managed Redis (e.g. ElastiCache) disables CONFIG - the flags must be set in the parameter group instead
+        if keyspace_notifications_enabled is not False:
+            logger.warning(
+                "Could not enable keyspace notifications: {}. Falling back to polling every {} seconds",
+                e,
+                EXTEND_INTERVAL,
+            )
+        keyspace_notifications_enabled = False
+    return keyspace_notifications_enabled
 
 
 def main_loop():
     """
     Main loop of the daemon.
-    Manages lock acquisition, container state, and periodic lock extension for all containers.
+    Locks held by this instance are extended every EXTEND_INTERVAL seconds. Takeover of other containers is
+    event-driven - we listen for the keyspace notification fired when their lock expires or is deleted.
+    A full sweep of all containers runs every LOCK_TIMEOUT seconds in case a notification was missed,
+    or every EXTEND_INTERVAL seconds if keyspace notifications could not be enabled. Notifications are
+    re-checked on every sweep since Redis forgets them on restart or failover.
     """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    # Setup talks to Redis, so it runs inside the loop to be retried if Redis is unreachable at boot
+    setup_done = False
+    # Deadlines are taken on the monotonic clock before doing any work, so the extension cadence
+    # does not drift with the time spent in Redis/Docker calls or with wall-clock adjustments
+    next_extend = next_sweep = time.monotonic()
     while True:
         try:
-            for container_id in CONTAINERS:
-                manage_container(container_id)
-
-            # Sleep for half the lock timeout before next check - this is mostly for extending the lock
-            time.sleep(LOCK_TIMEOUT / 2)
+            if not setup_done:
+                pubsub.subscribe(LOCK_EXPIRED_CHANNEL, LOCK_DELETED_CHANNEL)
+                setup_done = True
+
+            now = time.monotonic()
+            if now >= next_sweep:
+                detect_native_conditional_commands()
+                # Without notifications the sweep is the only takeover path, so run it at every extension
+                next_sweep = now + (
+                    LOCK_TIMEOUT if enable_keyspace_notifications() else EXTEND_INTERVAL
+                )
+                next_extend = now + EXTEND_INTERVAL
+                manage_containers(list(CONTAINERS))
+            elif now >= next_extend:
+                next_extend = now + EXTEND_INTERVAL
+                # Only extend the locks we hold - standby instances do not touch Redis here
+                if current_locks:
+                    manage_containers(list(current_locks))
+
+            # Wait for a lock to be freed for the remainder of the interval, until the next extension or sweep is due
+            message = pubsub.get_message(
+                timeout=max(0, min(next_extend, next_sweep) - time.monotonic())
+            )
+            if message:
+                container_id = LOCK_NAME_TO_CONTAINER.get(message["data"])
+                if container_id is not None and container_id not in current_locks:
+                    logger.info("Lock for {} freed, attempting takeover", container_id)
+                    manage_containers([container_id])
         except redis.exceptions.ConnectionError:
             logger.error("Lost connection to Redis. Retrying in 10 seconds...")
             time.sleep(10)
         except docker.errors.APIError as e:
-            logger.error(f"Docker API error: {str(e)}. Retrying in 10 seconds...")
+            logger.error("Docker API error: {}. Retrying in 10 seconds...", e)
             time.sleep(10)
 
 
@@ -227,7 +509,7 @@ if __name__ == "__main__":
     try:
         main_loop()
     except Exception as e:
-        logger.error(f"Error Running Daemon Script: {str(e)}")
+        logger.error("Error Running Daemon Script: {}", e)
         traceback.print_exc()
         cleanup()
         sys.exit(1)